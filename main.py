@@ -1,13 +1,18 @@
 import asyncio
-import random
 import smtplib
 import ssl
 import re
+import secrets
 import json
+import os
+import threading
 import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email import message_from_bytes, policy
 from email.message import EmailMessage
 from email.utils import formataddr
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 from pathlib import Path
 
 from astrbot.api.event import filter, AstrMessageEvent
@@ -15,8 +20,84 @@ from astrbot.api.star import Context, Star, StarTools, register
 from astrbot.api import logger
 import astrbot.api.message_components as Comp
 
+try:
+    import orjson
+except ImportError: # 未安装 orjson 时回退到标准库 json
+    orjson = None
+
+# 邮箱格式校验
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+\-]+@[a-zA-Z0-9.\-]+\.[a-zA-Z]{2,}$')
+
+# 仅包含6位数字验证码的消息
+_CODE_RE = re.compile(r'^\s*(\d{6})\s*$')
+
+# 模板中支持的占位符
+_PLACEHOLDER_RE = re.compile(r'\{(at_user|code|group_name|group_id|timeout|remaining)\}')
+
+def _compile_template(template: str) -> str:
+    """将模板转换为 str.format_map 格式: 保留已知占位符，转义其余花括号 (如 HTML 中的 CSS)"""
+    parts = []
+    last = 0
+    for m in _PLACEHOLDER_RE.finditer(template):
+        parts.append(template[last:m.start()].replace("{", "{{").replace("}", "}}"))
+        parts.append(m.group(0))
+        last = m.end()
+    parts.append(template[last:].replace("{", "{{").replace("}", "}}"))
+    return "".join(parts)
+
+def _render(template: str, **values: str) -> str:
+    """单次扫描渲染已编译的模板，缺失的占位符替换为空字符串"""
+    return template.format_map(defaultdict(str, values))
+
+def _json_dumps(data: Any) -> bytes:
+    """序列化持久化数据，优先使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+# 持久化数据格式版本 (2: 按群分组)
+DATA_VERSION = 2
+
+# 数据变更后延迟落盘的时间(秒)，期间的多次变更合并为一次写入
+SAVE_DEBOUNCE_SECONDS = 1.0
+
+# 每位待验证用户仅保留最近若干个验证码，重复 /验证码 时最旧的验证码失效
+MAX_ACTIVE_CODES = 3
+
+# 群名缓存有效期(秒)及最多缓存的群数量
+GROUP_NAME_CACHE_TTL = 300
+GROUP_NAME_CACHE_SIZE = 1024
+
+# 预构建邮件骨架中的占位标记，发送时直接在序列化后的字节中替换
+_CODE_SENTINEL = "__QQEV_CODE__"
+_TO_SENTINEL = "__QQEV_TO__"
+# 最多缓存的邮件骨架数量 (按群号与群名区分)
+EMAIL_SKELETON_CACHE_SIZE = 256
+
+# 单次从队列中取出并复用同一 SMTP 会话发送的最大邮件数
+MAIL_BATCH_SIZE = 32
+
+# 邮件发送失败后的最大重试次数，第 n 次重试前等待 4**n 秒 (1s, 4s, 16s)
+MAIL_MAX_RETRIES = 3
+
+# 邮件队列元素: (收件邮箱, 8bit 邮件字节 (骨架不可用时为 None), 验证码, 群名, group_id, user_id, 已重试次数)
+_MailItem = Tuple[str, Optional[bytes], str, str, int, int, int]
+
+def _is_transient_error(e: Exception) -> bool:
+    """仅连接中断、网络错误及 4xx 临时性响应值得重试；认证失败、5xx 拒收等直接判定失败"""
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
 @register("qq_email_verify", "5060ti个马力的6999", "入群验证但是邮箱", "1.3.0", "https://github.com/HSOS6/astrbot_plugin_qq_email_verify")
 class QQEmailVerifyPlugin(Star):
+    # 共享的 SSL 上下文，避免每次连接重新加载系统 CA 证书 (SSLContext 可在多线程间共用)
+    _SSL_CTX = ssl.create_default_context()
+
     def __init__(self, context: Context, config: Dict[str, Any]):
         super().__init__(context)
         self.config = config
@@ -26,86 +107,187 @@ class QQEmailVerifyPlugin(Star):
         if not self.data_dir.exists():
             self.data_dir.mkdir(parents=True, exist_ok=True)
         self.data_file = self.data_dir / "verifications.json"
+        self._write_lock = threading.Lock()
+        # 快照序号: 保证较旧的快照不会覆盖已写入的较新快照
+        self._snapshot_seq = 0
+        self._written_seq = 0
         
-        # pending_verifications structure:
+        # 复用的 SMTP 连接 (避免每封邮件都重新握手和登录)
+        self._smtp_conn: Optional[smtplib.SMTP] = None
+        self._smtp_lock = asyncio.Lock()
+        # SMTP 的阻塞操作 (含 DNS 解析、TLS 握手) 在独立的有界线程池中执行
+        self._smtp_executor = ThreadPoolExecutor(
+            max_workers=max(1, int(self.config.get("smtp_workers", 4))),
+            thread_name_prefix="qqverify-smtp",
+        )
+        
+        # 邮件发送队列，由单个后台任务批量消费
+        # 队列元素见 _MailItem
+        self._mail_queue: asyncio.Queue = asyncio.Queue()
+        self._sender_task = asyncio.create_task(self._sender_loop())
+        # 后台任务: 等待退避后重新入队的重试、发送失败的群内提示
+        self._retry_tasks: set = set()
+        
+        # 群名缓存: group_id -> (获取时间, 群名)
+        self._group_name_cache: Dict[int, Tuple[float, str]] = {}
+        # 邮件骨架缓存: (group_id, 群名) -> 含占位标记的邮件字节
+        self._email_skeletons: Dict[Tuple[int, str], bytes] = {}
+        self._use_email_skeleton = True
+        
+        # pending_by_group structure (按群分组，群消息只需在本群的小表中查找):
         # {
-        #   "user_id": {
-        #       "group_id": str,
-        #       "codes": set,
-        #       "join_time": float,
-        #       "task": asyncio.Task (only for active session)
+        #   group_id (int): {
+        #       user_id (int): {
+        #           "codes": deque (最近 MAX_ACTIVE_CODES 个有效验证码),
+        #           "join_time": float,
+        #           "at_user": str (预先生成的 @ 消息段，不持久化),
+        #           "task": asyncio.Task (only for active session)
+        #       }
         #   }
         # }
-        self.pending_verifications: Dict[str, Dict[str, Any]] = self._load_data()
+        self.pending_by_group: Dict[int, Dict[int, Dict[str, Any]]] = self._load_data()
         
         # 预加载配置
-        self.whitelist_groups = set()
-        self.blacklist_groups = set()
+        self.whitelist_groups = frozenset()
+        self.blacklist_groups = frozenset()
         self.kick_delay_seconds = 300
         self._load_config()
         
+        # 后台防抖写入任务: 状态变更只需 self._dirty.set()
+        self._dirty = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+        
         # 为恢复的状态启动踢出任务
         self._resume_tasks()
 
-    def _load_data(self) -> Dict[str, Any]:
+    def _load_data(self) -> Dict[int, Dict[int, Dict[str, Any]]]:
         """从文件加载持久化数据"""
         if self.data_file.exists():
             try:
                 with open(self.data_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    # 将 codes 转换回 set
-                    for uid in data:
-                        data[uid]['codes'] = set(data[uid]['codes'])
-                    return data
+                if data.get("version") != DATA_VERSION:
+                    # 旧格式: {user_id: {"group_id": ..., ...}}，按群重新分组
+                    groups: Dict[str, Dict[str, Any]] = {}
+                    for uid, info in data.items():
+                        groups.setdefault(str(info.pop("group_id")), {})[uid] = info
+                else:
+                    groups = data["groups"]
+
+                # JSON 键只能是字符串，恢复为 int；将 codes 转换回 deque，并重建 @ 消息段
+                pending = {}
+                for gid, users in groups.items():
+                    group_map = pending[int(gid)] = {}
+                    for uid, info in users.items():
+                        info['codes'] = deque(info['codes'], maxlen=MAX_ACTIVE_CODES)
+                        info['at_user'] = f"[CQ:at,qq={uid}]"
+                        group_map[int(uid)] = info
+                return pending
             except Exception as e:
                 logger.error(f"[QQEmailVerify] 加载持久化数据失败: {e}")
         return {}
 
-    def _save_data(self):
-        """保存数据到文件"""
-        try:
-            # 准备可序列化的副本
-            save_data = {}
-            for uid, info in self.pending_verifications.items():
-                save_data[uid] = {
-                    "group_id": info["group_id"],
+    def _snapshot_data(self) -> Tuple[int, Dict[str, Any]]:
+        """准备可序列化的副本 (不含 task)，返回 (快照序号, 数据)"""
+        self._snapshot_seq += 1
+        groups = {}
+        for gid, group_map in self.pending_by_group.items():
+            groups[str(gid)] = {
+                str(uid): {
                     "codes": list(info["codes"]),
                     "join_time": info.get("join_time", time.time()),
                     "welcome_msg_id": info.get("welcome_msg_id") # 保存 welcome_msg_id
                 }
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(save_data, f, ensure_ascii=False, indent=2)
+                for uid, info in group_map.items()
+            }
+        return self._snapshot_seq, {"version": DATA_VERSION, "groups": groups}
+
+    def _write_json(self, seq: int, save_data: Dict[str, Any]):
+        """将快照写入文件 (可在线程中执行)"""
+        try:
+            with self._write_lock:
+                if seq <= self._written_seq:
+                    return
+                self._written_seq = seq
+                # 先写临时文件再原子替换，避免写入中途退出导致文件损坏
+                tmp_file = self.data_file.with_suffix(".json.tmp")
+                tmp_file.write_bytes(_json_dumps(save_data))
+                os.replace(tmp_file, self.data_file)
         except Exception as e:
             logger.error(f"[QQEmailVerify] 保存持久化数据失败: {e}")
 
+    def _save_data(self):
+        """立即同步保存数据到文件"""
+        self._write_json(*self._snapshot_data())
+
+    async def _flush_loop(self):
+        """后台防抖写入: 等待变更标记，合并短时间内的多次变更后在线程中落盘"""
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(SAVE_DEBOUNCE_SECONDS)
+            self._dirty.clear()
+            seq, snapshot = self._snapshot_data()
+            await asyncio.to_thread(self._write_json, seq, snapshot)
+
     def _resume_tasks(self):
         """为加载的状态恢复踢出任务"""
         now = time.time()
-        for uid, info in list(self.pending_verifications.items()):
-            join_time = info.get("join_time", now)
-            elapsed = now - join_time
-            remaining = self.kick_delay_seconds - elapsed
-            
-            if remaining <= 0:
-                # 已过期，立即启动一个踢出任务
-                info["task"] = asyncio.create_task(self._kick_task(uid, info["group_id"], delay=0))
-            else:
-                info["task"] = asyncio.create_task(self._kick_task(uid, info["group_id"], delay=remaining))
+        for gid, group_map in self.pending_by_group.items():
+            for uid, info in group_map.items():
+                join_time = info.get("join_time", now)
+                elapsed = now - join_time
+                remaining = self.kick_delay_seconds - elapsed
+                
+                if remaining <= 0:
+                    # 已过期，立即启动一个踢出任务
+                    info["task"] = asyncio.create_task(self._kick_task(uid, gid, delay=0))
+                else:
+                    info["task"] = asyncio.create_task(self._kick_task(uid, gid, delay=remaining))
+
+    def _get_pending(self, group_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        """获取待验证记录"""
+        group_map = self.pending_by_group.get(group_id)
+        return group_map.get(user_id) if group_map else None
+
+    def _pop_pending(self, group_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        """移除待验证记录，群内无待验证用户时一并移除该群"""
+        group_map = self.pending_by_group.get(group_id)
+        if not group_map:
+            return None
+        info = group_map.pop(user_id, None)
+        if not group_map:
+            del self.pending_by_group[group_id]
+        return info
 
     async def terminate(self):
         """插件销毁时保存数据"""
         self._save_data()
-        # 取消所有正在运行的任务
-        for info in self.pending_verifications.values():
-            if "task" in info and not info["task"].done():
-                info["task"].cancel()
+        # 一次性取消所有正在运行的任务 (含后台写入与邮件发送任务)，再统一等待其结束
+        tasks = [
+            info["task"]
+            for group_map in self.pending_by_group.values()
+            for info in group_map.values()
+            if "task" in info and not info["task"].done()
+        ]
+        tasks.append(self._flusher)
+        tasks.append(self._sender_task)
+        tasks.extend(self._retry_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 取消任务不会中断线程池中正在执行的 SMTP 调用；等其结束后再关闭连接，避免与 sendmail 并发操作同一连接
+        await asyncio.to_thread(self._smtp_executor.shutdown, wait=True)
+        await asyncio.to_thread(self._close_connection)
 
     def _load_config(self):
-        """加载配置"""
+        """加载配置并缓存为实例属性 (配置变更后 AstrBot 会重载插件，届时重新读取)"""
         whitelist = self.config.get("whitelist_groups", [])
         blacklist = self.config.get("blacklist_groups", [])
-        self.whitelist_groups = {str(g).strip() for g in whitelist if str(g).strip()}
-        self.blacklist_groups = {str(g).strip() for g in blacklist if str(g).strip()}
+        self.whitelist_groups = frozenset(int(str(g).strip()) for g in whitelist if str(g).strip().isdigit())
+        self.blacklist_groups = frozenset(int(str(g).strip()) for g in blacklist if str(g).strip().isdigit())
+        # 白名单优先；预先确定生效的名单，使 _is_group_enabled 只需一次集合查找
+        self._group_filter_is_whitelist = bool(self.whitelist_groups)
+        self._enabled_groups_cache = self.whitelist_groups if self._group_filter_is_whitelist else self.blacklist_groups
         self.kick_delay_seconds = int(self.config.get("kick_delay_seconds", 300))
         
         # 提醒配置
@@ -114,81 +296,266 @@ class QQEmailVerifyPlugin(Star):
         # 确保提醒时间小于总超时时间
         if self.timeout_reminder_seconds >= self.kick_delay_seconds:
             self.timeout_reminder_seconds = max(0, self.kick_delay_seconds - 60)
+        
+        # SMTP 配置
+        self.smtp_host = self.config.get("smtp_host", "smtp.qq.com")
+        self.smtp_port = int(self.config.get("smtp_port", 465))
+        self.username = self.config.get("username", "")
+        self.password = self.config.get("password", "")
+        self.use_ssl = bool(self.config.get("use_ssl", True))
+        self.from_addr = self.config.get("from_address", "")
+        self.from_name = self.config.get("from_display_name", "AstrBot验证助手")
+        
+        # 消息模板 (预编译为 format_map 格式)
+        self.verify_email_subject = self.config.get("verify_email_subject", "入群验证码")
+        self.verify_email_template = _compile_template(self.config.get("verify_email_template", "<p>欢迎加入 {group_name} ({group_id})！</p><p>验证码: {code}</p>"))
+        self.welcome_msg_template = _compile_template(self.config.get("welcome_msg_template", "{at_user} 欢迎入群！验证码已发送至您的QQ邮箱..."))
+        self.verify_success_msg = _compile_template(self.config.get("verify_success_msg", "{at_user} 验证通过，欢迎加入！"))
+        self.kick_msg_template = _compile_template(self.config.get("kick_msg_template", "{at_user} 验证超时，已移出群聊。"))
+        self.timeout_reminder_msg = _compile_template(self.config.get("timeout_reminder_msg", "{at_user} 您的验证即将超时..."))
+        self.email_failed_msg = _compile_template(self.config.get("email_failed_msg", "{at_user} 验证邮件发送失败，请发送 /验证码 重新获取。"))
+        
+        # 超时时间(分钟)，用于模板渲染
+        self.timeout_min_str = str(self.kick_delay_seconds // 60)
+        
+        # 校验邮件骨架替换后的结构完整，否则回退为逐封构造邮件
+        self._email_skeletons.clear()
+        self._use_email_skeleton = self._check_email_skeleton()
 
-    def _is_group_enabled(self, group_id: str) -> bool:
+    def _is_group_enabled(self, group_id: int) -> bool:
         """检查群是否启用验证"""
-        # 白名单模式
-        if self.whitelist_groups:
-            return group_id in self.whitelist_groups
-            
-        # 黑名单模式
-        if self.blacklist_groups:
-            return group_id not in self.blacklist_groups
-            
-        # 默认启用
-        return True
+        # 白名单模式: 在名单内启用；黑名单模式 (含未配置): 不在名单内启用
+        return (group_id in self._enabled_groups_cache) == self._group_filter_is_whitelist
 
     def _generate_code(self) -> str:
         """生成6位随机数字验证码"""
-        return str(random.randint(100000, 999999))
-
-    def _send_email_sync(self, to_email: str, subject: str, html_body: str) -> bool:
-        """同步发送邮件逻辑"""
-        smtp_host = self.config.get("smtp_host", "smtp.qq.com")
-        smtp_port = int(self.config.get("smtp_port", 465))
-        username = self.config.get("username", "")
-        password = self.config.get("password", "")
-        use_ssl = self.config.get("use_ssl", True)
-        from_addr = self.config.get("from_address", "")
-        from_name = self.config.get("from_display_name", "AstrBot验证助手")
-
-        if not username or not password or not from_addr:
-            logger.error("[QQEmailVerify] SMTP配置不完整，无法发送邮件")
-            return False
+        return f"{secrets.randbelow(900000) + 100000:06d}"
 
+    def _connect_sync(self) -> smtplib.SMTP:
+        """建立 SMTP 连接并登录"""
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.smtp_host, self.smtp_port, context=self._SSL_CTX, timeout=30)
+        else:
+            server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=30)
+            server.ehlo()
+            server.starttls(context=self._SSL_CTX) # 尝试启用TLS
+            server.ehlo()
         try:
-            msg = EmailMessage()
-            msg["Subject"] = subject
-            msg["From"] = formataddr((from_name, from_addr))
-            msg["To"] = to_email
-            msg.set_content("请使用支持HTML的邮件客户端查看验证码。")
-            msg.add_alternative(html_body, subtype="html")
-
-            context = ssl.create_default_context()
-            if use_ssl:
-                with smtplib.SMTP_SSL(smtp_host, smtp_port, context=context) as server:
-                    server.login(username, password)
-                    server.send_message(msg)
-            else:
-                with smtplib.SMTP(smtp_host, smtp_port) as server:
-                    server.ehlo()
-                    server.starttls(context=context) # 尝试启用TLS
-                    server.ehlo()
-                    server.login(username, password)
-                    server.send_message(msg)
-            return True
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _close_connection(self):
+        """关闭复用的 SMTP 连接"""
+        server, self._smtp_conn = self._smtp_conn, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    async def _run_smtp(self, func, *args):
+        """在 SMTP 专用线程池中执行阻塞调用"""
+        return await asyncio.get_running_loop().run_in_executor(self._smtp_executor, func, *args)
+
+    async def _get_connection(self) -> smtplib.SMTP:
+        """获取可用的 SMTP 连接，断开时自动重连 (调用方需持有 _smtp_lock)"""
+        if self._smtp_conn is not None:
+            try:
+                await self._run_smtp(self._smtp_conn.noop)
+                return self._smtp_conn
+            except (smtplib.SMTPServerDisconnected, AttributeError, OSError) as e:
+                logger.info(f"[QQEmailVerify] SMTP 连接已失效，正在重连: {e}")
+                await self._run_smtp(self._close_connection)
+
+        self._smtp_conn = await self._run_smtp(self._connect_sync)
+        return self._smtp_conn
+
+    def _build_email(self, to_email: str, html_body: str, cte: Optional[str] = None) -> bytes:
+        """构造验证邮件并序列化为 SMTP 可直接发送的字节"""
+        msg = EmailMessage()
+        msg["Subject"] = self.verify_email_subject
+        msg["From"] = formataddr((self.from_name, self.from_addr))
+        msg["To"] = to_email
+        msg.set_content("请使用支持HTML的邮件客户端查看验证码。", cte=cte)
+        msg.add_alternative(html_body, subtype="html", cte=cte)
+        return msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+
+    def _build_email_skeleton(self, group_id: int, group_name: str) -> Optional[bytes]:
+        """构造含验证码/收件人占位标记的邮件骨架，行过长无法使用 8bit 编码时返回 None"""
+        html_body = _render(self.verify_email_template, code=_CODE_SENTINEL, group_name=group_name, group_id=str(group_id), timeout=self.timeout_min_str)
+        # 使用 8bit 编码，保证占位标记不会被 base64/quoted-printable 编码或折行拆开
+        skeleton = self._build_email(_TO_SENTINEL, html_body, cte="8bit")
+        if any(len(line) > 998 for line in skeleton.split(b"\r\n")):
+            return None
+        return skeleton
+
+    def _check_email_skeleton(self) -> bool:
+        """启动时校验: 替换占位标记后的邮件能正确解析出收件人与验证码"""
+        try:
+            skeleton = self._build_email_skeleton(0, "群聊")
+            if skeleton is None:
+                return False
+            to_email, code = "10000@qq.com", "123456"
+            parsed = message_from_bytes(self._fill_email_skeleton(skeleton, to_email, code), policy=policy.default)
+            html = parsed.get_body(("html",)).get_content()
+            return parsed["To"] == to_email and html.count(code) == skeleton.count(_CODE_SENTINEL.encode())
         except Exception as e:
-            logger.error(f"[QQEmailVerify] 发送邮件失败: {e}")
+            logger.warning(f"[QQEmailVerify] 邮件骨架校验失败，将逐封构造邮件: {e}")
             return False
 
-    async def _send_email_async(self, to_email: str, code: str, group_name: str, group_id: str):
-        """异步发送验证邮件"""
-        subject = self.config.get("verify_email_subject", "入群验证码")
-        template = self.config.get("verify_email_template", "<p>欢迎加入 {group_name} ({group_id})！</p><p>验证码: {code}</p>")
-        
-        # 计算超时时间(分钟)
-        timeout_min = str(int(self.config.get("kick_delay_seconds", 300)) // 60)
-        
-        html_body = template.replace("{code}", code).replace("{group_name}", group_name).replace("{group_id}", group_id).replace("{timeout}", timeout_min)
-        
-        logger.info(f"[QQEmailVerify] 正在向 {to_email} 发送验证码 {code}")
-        success = await asyncio.to_thread(self._send_email_sync, to_email, subject, html_body)
-        if success:
-            logger.info(f"[QQEmailVerify] 邮件发送成功 -> {to_email}")
+    @staticmethod
+    def _fill_email_skeleton(skeleton: bytes, to_email: str, code: str) -> bytes:
+        """在邮件骨架中填入收件人与验证码"""
+        return skeleton.replace(_TO_SENTINEL.encode(), to_email.encode()).replace(_CODE_SENTINEL.encode(), code.encode())
+
+    def _render_email(self, to_email: str, code: str, group_name: str, group_id: int) -> Optional[bytes]:
+        """渲染 8bit 验证邮件: 复用该群的邮件骨架，只替换收件人与验证码；骨架不可用时返回 None"""
+        if self._use_email_skeleton:
+            key = (group_id, group_name)
+            skeleton = self._email_skeletons.get(key)
+            if skeleton is None:
+                skeleton = self._build_email_skeleton(group_id, group_name)
+                if skeleton is not None:
+                    if len(self._email_skeletons) >= EMAIL_SKELETON_CACHE_SIZE:
+                        self._email_skeletons.pop(next(iter(self._email_skeletons)))
+                    self._email_skeletons[key] = skeleton
+            if skeleton is not None:
+                return self._fill_email_skeleton(skeleton, to_email, code)
+        return None
+
+    def _send_email_sync(self, server: smtplib.SMTP, item: _MailItem):
+        """同步发送邮件逻辑 (使用已登录的连接)"""
+        to_email, raw_msg, code, group_name, group_id = item[:5]
+        if raw_msg is not None and server.has_extn("8bitmime"):
+            server.sendmail(self.from_addr, [to_email], raw_msg, mail_options=("BODY=8BITMIME",))
         else:
-            logger.error(f"[QQEmailVerify] 邮件发送失败 -> {to_email}")
+            # 骨架不可用或服务器不支持 8BITMIME 时，逐封构造 7bit 安全的 quoted-printable 邮件
+            html_body = _render(self.verify_email_template, code=code, group_name=group_name, group_id=str(group_id), timeout=self.timeout_min_str)
+            server.sendmail(self.from_addr, [to_email], self._build_email(to_email, html_body, cte="quoted-printable"))
+        # 重置会话状态以便复用连接发送下一封
+        server.rset()
+
+    async def _sender_loop(self):
+        """后台邮件发送任务: 批量取出已渲染的邮件，复用同一 SMTP 会话依次发送"""
+        while True:
+            batch = [await self._mail_queue.get()]
+            while len(batch) < MAIL_BATCH_SIZE:
+                try:
+                    batch.append(self._mail_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            if not self.username or not self.password or not self.from_addr:
+                logger.error(f"[QQEmailVerify] SMTP配置不完整，无法发送 {len(batch)} 封邮件")
+                # 不重试，直接在群内提示用户，避免验证会话在无提示的情况下超时被踢
+                for item in batch:
+                    self._handle_send_failure(item, retryable=False)
+                continue
+
+            failed = []
+            async with self._smtp_lock:
+                # 每批只获取一次连接，邮件之间依靠 RSET 重置会话；发送出错后才为下一封重新获取
+                server = None
+                for i, item in enumerate(batch):
+                    to_email = item[0]
+                    if server is None:
+                        try:
+                            server = await self._get_connection()
+                        except asyncio.CancelledError:
+                            raise
+                        except Exception as e:
+                            # 无法建立连接时不再逐封重连，本批剩余邮件统一进入失败处理
+                            logger.error(f"[QQEmailVerify] 连接 SMTP 服务器失败，本批剩余 {len(batch) - i} 封邮件未发送: {e}")
+                            retryable = _is_transient_error(e)
+                            failed.extend((rest, retryable) for rest in batch[i:])
+                            break
 
-    async def _kick_task(self, user_id: str, group_id: str, delay: Optional[int] = None):
+                    logger.info(f"[QQEmailVerify] 正在向 {to_email} 发送验证邮件")
+                    try:
+                        await self._run_smtp(self._send_email_sync, server, item)
+                        logger.info(f"[QQEmailVerify] 邮件发送成功 -> {to_email}")
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.error(f"[QQEmailVerify] 邮件发送失败 -> {to_email}: {e}")
+                        # 连接状态未知，丢弃后下次重新建立
+                        await self._run_smtp(self._close_connection)
+                        server = None
+                        failed.append((item, _is_transient_error(e)))
+
+            for item, retryable in failed:
+                self._handle_send_failure(item, retryable)
+
+    def _track_task(self, coro):
+        """启动后台任务并记录，插件销毁时统一取消"""
+        task = asyncio.create_task(coro)
+        self._retry_tasks.add(task)
+        task.add_done_callback(self._retry_tasks.discard)
+
+    def _handle_send_failure(self, item: _MailItem, retryable: bool):
+        """发送失败: 临时性错误按指数退避重新入队，重试耗尽后在群内提示用户重新获取"""
+        to_email, group_id, user_id, attempt = item[0], item[4], item[5], item[6]
+        info = self._get_pending(group_id, user_id)
+        if info is None:
+            # 用户已验证通过或离开，无需重试
+            return
+
+        if retryable and attempt < MAIL_MAX_RETRIES:
+            delay = 1 << (2 * attempt)
+            logger.info(f"[QQEmailVerify] {delay} 秒后重试发送 -> {to_email} (第 {attempt + 1} 次)")
+            self._track_task(self._retry_email(item[:-1] + (attempt + 1,), delay))
+            return
+
+        # 群内提示放到后台任务中发送，避免阻塞下一批邮件
+        self._track_task(self._notify_send_failure(group_id, info["at_user"]))
+
+    async def _notify_send_failure(self, group_id: int, at_user: str):
+        """在群内提示用户验证邮件发送失败"""
+        client = self.context.get_platform("aiocqhttp").get_client()
+        if client:
+            try:
+                fail_msg = _render(self.email_failed_msg, at_user=at_user)
+                await client.call_action("send_group_msg", group_id=group_id, message=fail_msg)
+            except Exception as e:
+                logger.warning(f"[QQEmailVerify] 发送邮件失败提示失败: {e}")
+
+    async def _retry_email(self, item: _MailItem, delay: int):
+        """等待退避时间后将邮件重新加入发送队列"""
+        await asyncio.sleep(delay)
+        await self._mail_queue.put(item)
+
+    async def _get_group_name(self, group_id: int, bot) -> str:
+        """获取群名 (带 TTL 缓存)，失败时返回群号"""
+        cached = self._group_name_cache.get(group_id)
+        now = time.monotonic()
+        if cached is not None and now - cached[0] < GROUP_NAME_CACHE_TTL:
+            return cached[1]
+
+        try:
+            g_info = await bot.call_action("get_group_info", group_id=group_id, no_cache=False)
+            group_name = g_info.get("group_name") or str(group_id)
+        except Exception as e:
+            logger.warning(f"[QQEmailVerify] 获取群信息失败: {e}")
+            return cached[1] if cached is not None else str(group_id)
+
+        # 重新插入以保持按获取时间排序，超出容量时淘汰最旧的条目
+        self._group_name_cache.pop(group_id, None)
+        self._group_name_cache[group_id] = (now, group_name)
+        if len(self._group_name_cache) > GROUP_NAME_CACHE_SIZE:
+            self._group_name_cache.pop(next(iter(self._group_name_cache)))
+        return group_name
+
+    async def _queue_verify_email(self, bot, to_email: str, code: str, group_id: int, user_id: int):
+        """获取群名后渲染验证邮件并加入发送队列"""
+        group_name = await self._get_group_name(group_id, bot)
+        raw_msg = self._render_email(to_email, code, group_name, group_id)
+        await self._mail_queue.put((to_email, raw_msg, code, group_name, group_id, user_id, 0))
+
+    async def _kick_task(self, user_id: int, group_id: int, delay: Optional[int] = None):
         """超时踢出任务"""
         if delay is None:
             delay = self.kick_delay_seconds
@@ -209,10 +576,9 @@ class QQEmailVerifyPlugin(Star):
                 await asyncio.sleep(reminder_time)
                 
                 # 发送提醒
-                if user_id in self.pending_verifications:
-                    info = self.pending_verifications[user_id]
-                    reminder_tmpl = self.config.get("timeout_reminder_msg", "{at_user} 您的验证即将超时...")
-                    reminder_msg = reminder_tmpl.replace("{at_user}", f"[CQ:at,qq={user_id}]").replace("{remaining}", str(self.timeout_reminder_seconds))
+                info = self._get_pending(group_id, user_id)
+                if info is not None:
+                    reminder_msg = _render(self.timeout_reminder_msg, at_user=info["at_user"], remaining=str(self.timeout_reminder_seconds))
                     
                     client = self.context.get_platform("aiocqhttp").get_client()
                     if client:
@@ -232,203 +598,199 @@ class QQEmailVerifyPlugin(Star):
                 await asyncio.sleep(delay)
             
             # 检查是否仍在待验证列表
-            if user_id in self.pending_verifications:
+            info = self._get_pending(group_id, user_id)
+            if info is not None:
                 logger.info(f"[QQEmailVerify] 用户 {user_id} 验证超时，执行踢出")
                 
                 # 发送踢出提示
-                kick_msg_tmpl = self.config.get("kick_msg_template", "{at_user} 验证超时，已移出群聊。")
-                kick_msg = kick_msg_tmpl.replace("{at_user}", f"[CQ:at,qq={user_id}]")
+                kick_msg = _render(self.kick_msg_template, at_user=info["at_user"])
                 
                 client = self.context.get_platform("aiocqhttp").get_client()
                 if client:
                     try:
                         await client.call_action("send_group_msg", group_id=group_id, message=kick_msg)
                         # 执行踢出
-                        await client.call_action("set_group_kick", group_id=group_id, user_id=int(user_id), reject_add_request=False)
+                        await client.call_action("set_group_kick", group_id=group_id, user_id=user_id, reject_add_request=False)
                     except Exception as e:
                         logger.error(f"[QQEmailVerify] 踢出用户失败: {e}")
                 
                 # 清理状态
-                if user_id in self.pending_verifications:
-                    del self.pending_verifications[user_id]
-                    self._save_data() # 保存变更
+                if self._pop_pending(group_id, user_id) is not None:
+                    self._dirty.set() # 保存变更
                     
         except asyncio.CancelledError:
             logger.info(f"[QQEmailVerify] 用户 {user_id} 验证任务已取消（验证通过或离开）")
         except Exception as e:
             logger.error(f"[QQEmailVerify] 踢出任务异常: {e}")
 
-    @filter.event_message_type(filter.EventMessageType.ALL)
-    async def on_event(self, event: AstrMessageEvent):
-        """统一事件处理"""
-        # 仅处理 aiocqhttp 平台
-        if event.get_platform_name() != "aiocqhttp":
-            return
-
-        if not hasattr(event, "message_obj") or not hasattr(event.message_obj, "raw_message"):
-            return
-            
-        raw = event.message_obj.raw_message
+    @filter.platform_adapter_type(filter.PlatformAdapterType.AIOCQHTTP)
+    @filter.event_message_type(filter.EventMessageType.GROUP_MESSAGE)
+    async def on_group_event(self, event: AstrMessageEvent):
+        """处理群消息与入群/退群通知 (aiocqhttp 的群通知事件同样按群消息类型分发，私聊不会进入此处)"""
+        raw = getattr(event.message_obj, "raw_message", None)
         if not isinstance(raw, dict):
             return
 
         post_type = raw.get("post_type")
-        
-        # 处理入群通知
-        if post_type == "notice" and raw.get("notice_type") == "group_increase":
-            user_id = str(raw.get("user_id"))
-            group_id = str(raw.get("group_id"))
-            
-            # 检查群是否启用验证
-            if not self._is_group_enabled(group_id):
+        if post_type == "message":
+            # 绝大多数消息来自无需验证的用户，先在本群的待验证表中查找并快速返回
+            group_map = self.pending_by_group.get(raw.get("group_id"))
+            if not group_map:
                 return
-            
-            # 忽略机器人自己
-            if user_id == str(event.get_self_id()):
+            user_id = raw.get("user_id")
+            verification = group_map.get(user_id)
+            if verification is None:
                 return
+            await self._handle_group_message(event, raw, user_id, verification)
+        elif post_type == "notice":
+            notice_type = raw.get("notice_type")
+            if notice_type == "group_increase":
+                await self._handle_group_increase(event, raw)
+            elif notice_type == "group_decrease":
+                self._handle_group_decrease(raw)
 
-            logger.info(f"[QQEmailVerify] 监测到新成员入群: {user_id} (群: {group_id})")
-            
-            # 生成验证码
-            code = self._generate_code()
-            email = f"{user_id}@qq.com"
-            
-            # 启动超时任务
-            task = asyncio.create_task(self._kick_task(user_id, group_id))
-            
-            # 记录状态
-            self.pending_verifications[user_id] = {
-                "group_id": group_id,
-                "codes": {code},
-                "join_time": time.time(),
-                "task": task
-            }
-            self._save_data() # 保存状态
-            
-            # 获取群名
-            group_name = group_id
-            try:
-                g_info = await event.bot.call_action("get_group_info", group_id=int(group_id), no_cache=True)
-                group_name = g_info.get("group_name", group_id)
-            except Exception as e:
-                logger.warning(f"[QQEmailVerify] 获取群信息失败: {e}")
+    async def _handle_group_increase(self, event: AstrMessageEvent, raw: Dict[str, Any]):
+        """处理入群通知"""
+        user_id = raw.get("user_id")
+        group_id = raw.get("group_id")
+        
+        # 检查群是否启用验证
+        if not self._is_group_enabled(group_id):
+            return
+        
+        # 忽略机器人自己
+        if user_id == raw.get("self_id"):
+            return
 
-            # 发送邮件
-            asyncio.create_task(self._send_email_async(email, code, group_name, group_id))
-            
-            # 发送群提示
-            timeout_min = int(self.config.get("kick_delay_seconds", 300)) // 60
-            welcome_tmpl = self.config.get("welcome_msg_template", "{at_user} 欢迎入群！验证码已发送至您的QQ邮箱...")
-            welcome_msg = welcome_tmpl.replace("{at_user}", f"[CQ:at,qq={user_id}]").replace("{timeout}", str(timeout_min))
-            ret = await event.bot.call_action("send_group_msg", group_id=group_id, message=welcome_msg)
-            
-            # 保存欢迎消息的 message_id 以便后续引用
-            welcome_msg_id = None
-            if ret and isinstance(ret, dict):
-                welcome_msg_id = ret.get("message_id")
-            elif ret and hasattr(ret, "message_id"):
-                 welcome_msg_id = ret.message_id
+        logger.info(f"[QQEmailVerify] 监测到新成员入群: {user_id} (群: {group_id})")
+        at_user = f"[CQ:at,qq={user_id}]"
+        
+        # 生成验证码
+        code = self._generate_code()
+        email = f"{user_id}@qq.com"
+        
+        # 启动超时任务
+        task = asyncio.create_task(self._kick_task(user_id, group_id))
+        
+        # 记录状态 (同一用户重复入群时取消旧的超时任务)
+        group_map = self.pending_by_group.setdefault(group_id, {})
+        previous = group_map.get(user_id)
+        if previous is not None:
+            previous["task"].cancel()
+        verification = group_map[user_id] = {
+            "codes": deque([code], maxlen=MAX_ACTIVE_CODES),
+            "join_time": time.time(),
+            "at_user": at_user,
+            "task": task
+        }
+        self._dirty.set() # 保存状态
+        
+        # 邮件只依赖群名，与发送群提示 (欢迎语不含群名) 并发执行
+        welcome_msg = _render(self.welcome_msg_template, at_user=at_user, timeout=self.timeout_min_str)
+        ret, _ = await asyncio.gather(
+            event.bot.call_action("send_group_msg", group_id=group_id, message=welcome_msg),
+            self._queue_verify_email(event.bot, email, code, group_id, user_id),
+            return_exceptions=True,
+        )
+        if isinstance(ret, Exception):
+            logger.warning(f"[QQEmailVerify] 发送群提示失败: {ret}")
+            ret = None
+        
+        # 保存欢迎消息的 message_id 以便后续引用
+        welcome_msg_id = None
+        if ret and isinstance(ret, dict):
+            welcome_msg_id = ret.get("message_id")
+        elif ret and hasattr(ret, "message_id"):
+             welcome_msg_id = ret.message_id
+        
+        if welcome_msg_id:
+            verification["welcome_msg_id"] = welcome_msg_id
+            self._dirty.set() # 更新保存状态
+
+    def _handle_group_decrease(self, raw: Dict[str, Any]):
+        """处理退群通知 (清理状态)"""
+        user_id = raw.get("user_id")
+        verification = self._pop_pending(raw.get("group_id"), user_id)
+        if verification is not None:
+            verification["task"].cancel()
+            self._dirty.set() # 保存状态
+            logger.info(f"[QQEmailVerify] 待验证用户 {user_id} 退群，清理状态")
+
+    async def _handle_group_message(self, event: AstrMessageEvent, raw: Dict[str, Any], user_id: int, verification: Dict[str, Any]):
+        """处理待验证用户的群消息 (验证)"""
+        group_id = raw.get("group_id")
+        
+        # 检查群是否启用验证 (虽然理论上不在验证列表就不会处理，但为了严谨)
+        if not self._is_group_enabled(group_id):
+            return
             
-            if welcome_msg_id:
-                self.pending_verifications[user_id]["welcome_msg_id"] = welcome_msg_id
-                self._save_data() # 更新保存状态
+        # 纯文本消息直接匹配原始消息，无需构造 message_str；
+        # 含 CQ 码 (如引用回复、@) 时回退到 message_str，它已去除这些消息段
+        text = raw.get("raw_message") or ""
+        if "[CQ:" in text:
+            text = event.message_str
+        m = _CODE_RE.match(text)
+        
+        # 简单的验证码匹配 logic
+        if m is not None and m.group(1) in verification["codes"]:
+            # 验证成功
+            logger.info(f"[QQEmailVerify] 用户 {user_id} 验证成功")
             
-        # 处理退群通知 (清理状态)
-        elif post_type == "notice" and raw.get("notice_type") == "group_decrease":
-            user_id = str(raw.get("user_id"))
-            if user_id in self.pending_verifications:
-                self.pending_verifications[user_id]["task"].cancel()
-                del self.pending_verifications[user_id]
-                self._save_data() # 保存状态
-                logger.info(f"[QQEmailVerify] 待验证用户 {user_id} 退群，清理状态")
-
-        # 处理群消息 (验证)
-        elif post_type == "message" and raw.get("message_type") == "group":
-            user_id = str(raw.get("user_id"))
-            group_id = str(raw.get("group_id"))
+            # 取消超时任务
+            verification["task"].cancel()
+            self._pop_pending(group_id, user_id)
+            self._dirty.set() # 保存状态
             
-            # 检查群是否启用验证 (虽然理论上不在验证列表就不会处理，但为了严谨)
-            if not self._is_group_enabled(group_id):
-                return
+            # 发送成功提示
+            success_msg = _render(self.verify_success_msg, at_user=verification["at_user"])
+            await event.bot.call_action("send_group_msg", group_id=group_id, message=success_msg)
             
-            # 检查是否在待验证列表
-            if user_id not in self.pending_verifications:
-                return
-                
-            verification = self.pending_verifications[user_id]
-            if verification["group_id"] != group_id:
+            # 停止事件继续传播 (可选，防止触发其他指令)
+            event.stop_event()
+        else:
+            # 检查是否是重发指令，如果是则放行
+            # 简单的字符串匹配，允许指令通过拦截
+            if m is None and text.lstrip().startswith(("/验证码", "验证码", "／验证码")):
                 return
-                
-            msg_text = event.message_str.strip()
-            
-            # 简单的验证码匹配 logic
-            if msg_text in verification["codes"]:
-                # 验证成功
-                logger.info(f"[QQEmailVerify] 用户 {user_id} 验证成功")
-                
-                # 取消超时任务
-                verification["task"].cancel()
-                del self.pending_verifications[user_id]
-                self._save_data() # 保存状态
-                
-                # 发送成功提示
-                success_tmpl = self.config.get("verify_success_msg", "{at_user} 验证通过，欢迎加入！")
-                success_msg = success_tmpl.replace("{at_user}", f"[CQ:at,qq={user_id}]")
-                await event.bot.call_action("send_group_msg", group_id=group_id, message=success_msg)
-                
-                # 停止事件继续传播 (可选，防止触发其他指令)
-                event.stop_event()
-            else:
-                # 检查是否是重发指令，如果是则放行
-                # 简单的字符串匹配，允许指令通过拦截
-                if msg_text.strip().startswith(("/验证码", "验证码", "／验证码")):
-                    return
 
-                # 拦截待验证用户的所有其他消息，防止刷屏或触发其他指令
-                event.stop_event()
+            # 拦截待验证用户的所有其他消息，防止刷屏或触发其他指令
+            event.stop_event()
 
+    @filter.platform_adapter_type(filter.PlatformAdapterType.AIOCQHTTP)
     @filter.command("验证码", alias={"验证码重发"})
     async def resend_verify_code(self, event: AstrMessageEvent, email: str = ""):
         """重新发送验证码。用法: /验证码 [邮箱]"""
-        user_id = str(event.get_sender_id())
-        group_id = str(event.get_group_id())
+        user_id = int(event.get_sender_id())
+        group_id = int(event.get_group_id() or 0) # 私聊时没有群号
         
         # 检查群是否启用
         if not self._is_group_enabled(group_id):
             return
 
-        if user_id not in self.pending_verifications:
+        verification = self._get_pending(group_id, user_id)
+        if verification is None:
+            if any(user_id in group_map for group_map in self.pending_by_group.values()):
+                yield event.plain_result("请在申请入群的群聊中使用此指令。")
+                return
             # 仅在用户确实在待验证状态时响应，或者忽略
             # 为了避免干扰正常聊天，如果不在待验证列表，可以选择不回复或回复提示
             yield event.plain_result("您当前不需要验证。")
             return
 
-        verification = self.pending_verifications[user_id]
-        if verification["group_id"] != group_id:
-            yield event.plain_result("请在申请入群的群聊中使用此指令。")
-            return
-
-        # 邮箱格式验证
-        target_email = email.strip() if email else f"{user_id}@qq.com"
-        email_regex = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_regex, target_email):
+        # 邮箱格式验证 (未指定邮箱时使用 QQ邮箱，无需校验)
+        target_email = email.strip()
+        if not target_email:
+            target_email = f"{user_id}@qq.com"
+        elif not _EMAIL_RE.match(target_email):
             yield event.plain_result(f"邮箱格式不正确: {target_email}")
             return
 
         # 生成新验证码
         new_code = self._generate_code()
-        verification["codes"].add(new_code)
-        self._save_data() # 保存状态
+        verification["codes"].append(new_code)
+        self._dirty.set() # 保存状态
         
-        # 获取群名
-        group_name = group_id
-        try:
-            g_info = await event.bot.call_action("get_group_info", group_id=int(group_id), no_cache=True)
-            group_name = g_info.get("group_name", group_id)
-        except Exception:
-            pass
-
-        # 发送邮件
-        asyncio.create_task(self._send_email_async(target_email, new_code, group_name, group_id))
+        # 获取群名并将邮件加入发送队列
+        await self._queue_verify_email(event.bot, target_email, new_code, group_id, user_id)
         
-        yield event.plain_result(f"已将新的验证码发送至 {target_email}，请查收。旧验证码依然有效。")
+        yield event.plain_result(f"已将新的验证码发送至 {target_email}，请查收。最近 {MAX_ACTIVE_CODES} 次发送的验证码均有效。")